@@ -15,7 +15,7 @@ from .open_musiclm import (MusicLM, TokenConditionedTransformer,
                            create_semantic_transformer)
 from .trainer import ClapRVQTrainer, HfHubertKmeansTrainer, SingleStageTrainer
 from .preprocess import DataPreprocessor
-from .utils import exists, beartype_jit
+from .utils import exists, beartype_jit, load_state_dict
 
 
 @dataclass
@@ -140,6 +140,14 @@ class SingleStageTrainerConfig:
     save_predicted_tokens: bool
     save_reconstructed_wave: bool
     use_preprocessed_data: bool
+    gradient_checkpointing: bool = False
+    checkpoint_policy: str = 'all'
+    mixed_precision: Optional[str] = None
+    num_workers: Optional[int] = None
+    persistent_workers: bool = True
+    prefetch_factor: int = 2
+    use_torch_compile: bool = False
+    audio_cache_folder: Optional[str] = None
 
 @dataclass
 class DataPreprocessorConfig:
@@ -197,7 +205,7 @@ def load_model(model, path):
     """helper class to load a model checkpoint"""
     path = Path(path)
     assert path.exists(), f'checkpoint does not exist at {str(path)}'
-    pkg = torch.load(str(path))
+    pkg = load_state_dict(path)
     model.load_state_dict(pkg)
 
 class disable_print:
@@ -9,12 +9,12 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torchaudio
-from beartype.door import is_bearable
 from beartype.typing import List, Literal, Optional, Tuple, Union
 from einops import rearrange
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, IterableDataset
 from torchaudio.functional import resample
+from tqdm import tqdm
 
 from .utils import (beartype_jit, curtail_to_multiple, default,
                     float32_to_int16, int16_to_float32,
@@ -74,6 +74,7 @@ class SoundDataset(Dataset):
         ignore_files: Optional[List[str]] = None,
         ignore_load_errors=True,
         random_crop=True,
+        cache_folder=None,
     ):
         super().__init__()
         path = Path(folder)
@@ -83,13 +84,32 @@ class SoundDataset(Dataset):
         ignore_files = default(ignore_files, [])
         num_ignored = 0
         ignore_file_set = set([f.split('/')[-1] for f in ignore_files])
-        for ext in exts:
-            for file in path.glob(f'**/*.{ext}'):
+
+        # read audio resampled ahead of time by cache_resampled_audio, instead of decoding and resampling every file on the fly
+
+        self.cache_folder = Path(cache_folder) if exists(cache_folder) else None
+        self.cache_memmaps = dict()
+
+        self.resamplers = dict()
+
+        if exists(self.cache_folder):
+            self.cache_index = dict(np.load(str(self.cache_folder / 'index.npz')))
+            self.cache_ids = []
+            for cache_id, file in enumerate(self.cache_index['files']):
+                file = Path(str(file))
                 if file.name in ignore_file_set:
                     num_ignored += 1
                     continue
-                else:
-                    files.append(file)
+                files.append(file)
+                self.cache_ids.append(cache_id)
+        else:
+            for ext in exts:
+                for file in path.glob(f'**/*.{ext}'):
+                    if file.name in ignore_file_set:
+                        num_ignored += 1
+                        continue
+                    else:
+                        files.append(file)
         assert len(files) > 0, 'no sound files found'
         if num_ignored > 0:
             print(f'skipped {num_ignored} ignored files')
@@ -101,6 +121,10 @@ class SoundDataset(Dataset):
         self.target_sample_hz = cast_tuple(target_sample_hz)
         num_outputs = len(self.target_sample_hz)
 
+        if exists(self.cache_folder):
+            cached_sample_hz = self.cache_index['target_sample_hz'].tolist()
+            assert all(hz in cached_sample_hz for hz in self.target_sample_hz), f'audio cache only contains sample rates {cached_sample_hz}'
+
         self.max_length_seconds = cast_tuple(max_length_seconds, num_outputs)
         self.max_length = tuple([int(s * hz) if exists(s) else None for s, hz in zip(self.max_length_seconds, self.target_sample_hz)])
 
@@ -115,6 +139,9 @@ class SoundDataset(Dataset):
         return len(self.files)
 
     def __getitem__(self, idx):
+        if exists(self.cache_folder):
+            return self.process_cached_audio(idx)
+
         try:
             file = self.files[idx]
             data, sample_hz = torchaudio.load(file)
@@ -126,6 +153,86 @@ class SoundDataset(Dataset):
 
         return self.process_audio(data, sample_hz, pad_to_target_length=True)
 
+    def get_resampler(self, sample_hz, target_sample_hz):
+        # the sinc kernel only depends on the pair of sample rates, so build it once per pair (and per worker) instead of on every call
+        key = (sample_hz, target_sample_hz)
+        if key not in self.resamplers:
+            self.resamplers[key] = torchaudio.transforms.Resample(sample_hz, target_sample_hz)
+        return self.resamplers[key]
+
+    def get_cache_memmap(self, sample_hz):
+        # opened lazily, so each dataloader worker maps the file itself
+        if sample_hz not in self.cache_memmaps:
+            self.cache_memmaps[sample_hz] = np.memmap(str(self.cache_folder / f'audio.{sample_hz}.bin'), dtype=np.float16, mode='r')
+        return self.cache_memmaps[sample_hz]
+
+    def process_cached_audio(self, idx):
+        """
+        same as process_audio, but crops are computed in seconds and read straight from the pre-resampled audio cache.
+        normalization uses the mean and std of the whole original file, as stored in the cache index.
+        """
+        cache_id = self.cache_ids[idx]
+        cached_sample_hz = self.cache_index['target_sample_hz'].tolist()
+        duration = float(self.cache_index['durations'][cache_id])
+
+        num_outputs = len(self.target_sample_hz)
+        crops = [None for _ in range(num_outputs)]
+
+        sorted_max_length_seconds = sorted(
+            enumerate(self.max_length_seconds),
+            key=lambda t: (t[1] is not None, t[1])) # sort by max_length_seconds, while moving None to the beginning
+
+        # track the current crop window (which may extend past the audio when padded) and where its real audio ends
+
+        offset, window, audio_end = 0., duration, duration
+
+        for unsorted_i, max_length_seconds in sorted_max_length_seconds:
+            if exists(max_length_seconds):
+                if window > max_length_seconds:
+                    start = torch.rand(1).item() * (window - max_length_seconds) if self.random_crop else 0.
+                    offset += start
+                    audio_end = min(audio_end, offset + max_length_seconds)
+
+                window = max_length_seconds
+
+            crops[unsorted_i] = (offset, window, audio_end)
+
+        output = []
+
+        for i, ((offset, window, audio_end), target_sample_hz) in enumerate(zip(crops, self.target_sample_hz)):
+            rate_idx = cached_sample_hz.index(target_sample_hz)
+            cache_offset = int(self.cache_index['offsets'][rate_idx, cache_id])
+            cache_length = int(self.cache_index['lengths'][rate_idx, cache_id])
+
+            start = int(offset * target_sample_hz)
+            end = min(int(audio_end * target_sample_hz), cache_length)
+            target_length = default(self.max_length[i], cache_length)
+
+            memmap = self.get_cache_memmap(target_sample_hz)
+            data = torch.from_numpy(memmap[cache_offset + start:cache_offset + end].astype(np.float32))
+            data = data[:target_length]
+
+            if self.normalize[i]:
+                data = (data - float(self.cache_index['means'][cache_id])) / float(self.cache_index['stds'][cache_id])
+
+            data = F.pad(data, (0, target_length - data.size(0)), 'constant')
+
+            if not self.normalize[i]:
+                # quantize non-normalized audio to a valid waveform
+                data = int16_to_float32(float32_to_int16(data))
+
+            if exists(self.seq_len_multiple_of[i]):
+                data = curtail_to_multiple(data, self.seq_len_multiple_of[i])
+
+            output.append(data.float())
+
+        output = tuple(output)
+
+        if num_outputs == 1:
+            return output[0]
+
+        return output
+
     def process_audio(self, data, sample_hz, pad_to_target_length=True):
 
         if data.shape[0] > 1:
@@ -165,7 +272,7 @@ class SoundDataset(Dataset):
 
             data[unsorted_i] = temp_data_normalized if self.normalize[unsorted_i] else temp_data
         # resample if target_sample_hz is not None in the tuple
-        data_tuple = tuple((resample(d, sample_hz, target_sample_hz) if exists(target_sample_hz) else d) for d, target_sample_hz in zip(data, self.target_sample_hz))
+        data_tuple = tuple((self.get_resampler(sample_hz, target_sample_hz)(d) if exists(target_sample_hz) else d) for d, target_sample_hz in zip(data, self.target_sample_hz))
         # quantize non-normalized audio to a valid waveform
         data_tuple = tuple(d if self.normalize[i] else int16_to_float32(float32_to_int16(d)) for i, d in enumerate(data_tuple))
 
@@ -197,6 +304,71 @@ class SoundDataset(Dataset):
 
         return output
 
+def cache_resampled_audio(
+    files,
+    cache_folder,
+    target_sample_hz: Union[int, Tuple[int, ...]],
+    ignore_load_errors=True,
+):
+    """
+    decode and resample every file once, writing one float16 file per target sample rate (audio.{hz}.bin)
+    plus an index of offsets, lengths and normalization statistics (index.npz) that SoundDataset(cache_folder=...) reads from.
+    """
+    cache_folder = Path(cache_folder)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+
+    target_sample_hz = cast_tuple(target_sample_hz)
+
+    cached_files, durations, means, stds = [], [], [], []
+    offsets = [[] for _ in target_sample_hz]
+    lengths = [[] for _ in target_sample_hz]
+    positions = [0 for _ in target_sample_hz]
+
+    handles = [open(str(cache_folder / f'audio.{hz}.bin'), 'wb') for hz in target_sample_hz]
+
+    try:
+        for file in tqdm(files, desc='caching resampled audio'):
+            try:
+                data, sample_hz = torchaudio.load(file)
+            except:
+                if ignore_load_errors:
+                    continue
+                else:
+                    raise Exception(f'error loading file {file}')
+
+            if data.shape[0] > 1:
+                data = torch.mean(data, dim=0).unsqueeze(0)
+
+            cached_files.append(str(file))
+            durations.append(data.size(1) / sample_hz)
+            means.append(data.mean().item())
+            stds.append(torch.sqrt(data.var() + 1e-7).item())
+
+            for i, (hz, handle) in enumerate(zip(target_sample_hz, handles)):
+                resampled = resample(data, sample_hz, hz)
+                resampled = rearrange(resampled, '1 n -> n').numpy().astype(np.float16)
+                resampled.tofile(handle)
+
+                offsets[i].append(positions[i])
+                lengths[i].append(resampled.shape[0])
+                positions[i] += resampled.shape[0]
+    finally:
+        for handle in handles:
+            handle.close()
+
+    np.savez(
+        str(cache_folder / 'index.npz'),
+        files=np.array(cached_files),
+        durations=np.array(durations, dtype=np.float64),
+        means=np.array(means, dtype=np.float32),
+        stds=np.array(stds, dtype=np.float32),
+        target_sample_hz=np.array(target_sample_hz, dtype=np.int64),
+        offsets=np.array(offsets, dtype=np.int64),
+        lengths=np.array(lengths, dtype=np.int64),
+    )
+
+    return len(cached_files)
+
 # dataloader functions
 
 def collate_one_or_multiple_tensors(fn):
@@ -214,7 +386,8 @@ def collate_one_or_multiple_tensors(fn):
 
         outputs = []
         for datum in zip(*data):
-            if is_bearable(datum, Tuple[str, ...]):
+            # plain isinstance check instead of beartype's is_bearable, as this runs for every field of every batch
+            if all(isinstance(el, str) for el in datum):
                 output = list(datum)
             else:
                 output = fn(datum)
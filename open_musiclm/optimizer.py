@@ -15,13 +15,17 @@ def get_optimizer(
     eps = 1e-8,
     filter_by_requires_grad = False,
     group_wd_params = True,
+    fused = False,
     **kwargs
 ):
     if filter_by_requires_grad:
         params = list(filter(lambda t: t.requires_grad, params))
 
+    # only pass fused when requested, older versions of torch don't accept the argument
+    extra_kwargs = dict(fused = True) if fused else dict()
+
     if wd == 0:
-        return Adam(params, lr = lr, betas = betas, eps = eps)
+        return Adam(params, lr = lr, betas = betas, eps = eps, **extra_kwargs)
 
     if group_wd_params:
         wd_params, no_wd_params = separate_weight_decayable_params(params)
@@ -31,7 +35,7 @@ def get_optimizer(
             {'params': no_wd_params, 'weight_decay': 0},
         ]
 
-    return AdamW(params, lr = lr, weight_decay = wd, betas = betas, eps = eps)
+    return AdamW(params, lr = lr, weight_decay = wd, betas = betas, eps = eps, **extra_kwargs)
 
 def get_linear_scheduler(
     optimizer,
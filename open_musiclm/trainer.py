@@ -1,7 +1,11 @@
+import contextlib
 import itertools
 import math
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass
+from functools import cached_property
 from pathlib import Path
 from shutil import rmtree
 
@@ -17,6 +21,7 @@ from beartype.vale import Is
 from einops import rearrange, reduce, repeat
 from einops.layers.torch import Rearrange
 from torch import einsum, nn
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader, Dataset, random_split
 from tqdm import tqdm
 from typing_extensions import Annotated
@@ -33,7 +38,8 @@ from .utils import (all_rows_have_eos_id, append_eos_id,
                     batch_unique_consecutive, beartype_jit, ceil_div,
                     copy_file_to_folder, default, eval_decorator, exists,
                     generate_mask_with_prob, get_embeds, gumbel_sample,
-                    mask_out_after_eos_id, round_down_nearest_multiple, top_k)
+                    load_state_dict, mask_out_after_eos_id,
+                    round_down_nearest_multiple, save_state_dict, top_k)
 
 try:
     import wandb
@@ -56,6 +62,43 @@ def cycle(dl):
             yield data
 
 
+def prefetch_to_device(dl_iter, device):
+    """
+    move batches to device one step ahead of time, on a side stream when using cuda,
+    so that host to device copies of pinned batches overlap with the current step's compute.
+    """
+    device = torch.device(device)
+
+    if device.type != 'cuda':
+        for batch in dl_iter:
+            yield tuple(t.to(device) if torch.is_tensor(t) else t for t in batch)
+        return
+
+    stream = torch.cuda.Stream(device=device)
+
+    def to_device(batch):
+        with torch.cuda.stream(stream):
+            return tuple(t.to(device, non_blocking=True) if torch.is_tensor(t) else t for t in batch)
+
+    next_batch = to_device(next(dl_iter))
+
+    while exists(next_batch):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(stream)
+
+        batch = next_batch
+        for t in batch:
+            if torch.is_tensor(t):
+                t.record_stream(current_stream)
+
+        try:
+            next_batch = to_device(next(dl_iter))
+        except StopIteration:
+            next_batch = None
+
+        yield batch
+
+
 def yes_or_no(question):
     answer = input(f'{question} (y/n) ')
     return answer.lower() in ('yes', 'y')
@@ -67,6 +110,16 @@ def accum_log(log, new_logs):
         log[key] = old_value + new_value
     return log
 
+def copy_to_cpu(obj):
+    """recursively snapshot the tensors of a (nested) state dict to cpu"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    return obj
+
 def sanitize_hparams(hps):
     for key, value in hps.items():
         if not (
@@ -82,12 +135,7 @@ def sanitize_hparams(hps):
 # auto data to module keyword argument routing functions
 
 def has_duplicates(tup):
-    counts = dict()
-    for el in tup:
-        if el not in counts:
-            counts[el] = 0
-        counts[el] += 1
-    return any(filter(lambda count: count > 1, counts.values()))
+    return len(set(tup)) != len(tup)
 
 
 def determine_types(data, config):
@@ -106,6 +154,32 @@ def determine_types(data, config):
 def noop(*args, **kwargs):
     pass
 
+# gradient checkpointing
+
+def checkpoint_module(module):
+    """recompute the activations of a module during the backward pass instead of storing them"""
+    forward = module.forward
+
+    def inner(*args, **kwargs):
+        if not (module.training and torch.is_grad_enabled()):
+            return forward(*args, **kwargs)
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+
+    module.forward = inner
+    return module
+
+def apply_gradient_checkpointing(transformer: TokenConditionedTransformer, policy: Literal['all', 'attention_only'] = 'all'):
+    assert policy in ('all', 'attention_only'), f'invalid checkpoint policy: {policy}'
+
+    for attn, cross_attn, ff in transformer.transformer.layers:
+        checkpoint_module(attn)
+
+        if exists(cross_attn):
+            checkpoint_module(cross_attn)
+
+        if policy == 'all':
+            checkpoint_module(ff)
+
 
 @beartype_jit
 class SingleStageTrainer(nn.Module):
@@ -135,6 +209,7 @@ class SingleStageTrainer(nn.Module):
         ignore_load_errors=True,
         folder=None,
         use_preprocessed_data=False,
+        audio_cache_folder=None,
         lr=3e-4,
         lr_warmup=0,
         grad_accum_every=1,
@@ -147,11 +222,20 @@ class SingleStageTrainer(nn.Module):
         save_reconstructed_wave=True,
         save_model_every=1000,
         results_folder='./results',
+        gradient_checkpointing=False,
+        checkpoint_policy: Literal['all', 'attention_only'] = 'all',
+        mixed_precision: Optional[Literal['no', 'fp16', 'bf16']] = None,
+        num_workers: Optional[int] = None,
+        persistent_workers=True,
+        prefetch_factor=2,
+        use_torch_compile=False,
         accelerate_kwargs: dict = {},
         config_paths: Optional[List[str]] = None,
     ):
         super().__init__()
         kwargs_handler = DistributedDataParallelKwargs(find_unused_parameters=True)
+        if exists(mixed_precision):
+            accelerate_kwargs = {'mixed_precision': mixed_precision, **accelerate_kwargs}
         self.accelerator = Accelerator(**accelerate_kwargs, kwargs_handlers=[kwargs_handler])
 
         self.log_with = accelerate_kwargs['log_with'] if 'log_with' in accelerate_kwargs else None
@@ -217,15 +301,43 @@ class SingleStageTrainer(nn.Module):
         else:
             raise ValueError(f'invalid stage: {stage}')
 
+        # trade compute for memory by recomputing transformer activations in the backward pass
+
+        if gradient_checkpointing:
+            apply_gradient_checkpointing(transformer, policy=checkpoint_policy)
+
+        # the conditioning and tokenizing models (clap, wav2vec, neural codec) are frozen and always run in eval mode.
+        # only the transformer wrapper, which applies the forgetful causal mask during training, switches between train and eval
+
+        self.transformer_wrapper = self.train_wrapper.transformer_wrapper
+        self.transformer_wrapper.train()
+
+        for frozen_model in (self.wav2vec, self.audio_conditioner, self.neural_codec):
+            if exists(frozen_model):
+                frozen_model.eval()
+
         self.register_buffer('steps', torch.Tensor([0]))
 
+        # host side copy of steps, so reading the step count doesn't need a device sync.
+        # the buffer is only updated when checkpointing
+
+        self._py_steps: int = 0
+
+        # checkpoints are written from a background thread, so saving doesn't block training
+
+        self.save_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending_saves = []
+
         self.num_train_steps = num_train_steps
         self.batch_size = batch_size
         self.grad_accum_every = grad_accum_every
 
         # optimizers
 
-        self.optim = get_optimizer(transformer.parameters(), lr=lr, wd=wd)
+        # use the single kernel (fused) adam update when all parameters live on cuda
+
+        use_fused_optim = self.device.type == 'cuda' and all(p.is_cuda for p in transformer.parameters())
+        self.optim = get_optimizer(transformer.parameters(), lr=lr, wd=wd, fused=use_fused_optim)
 
         if lr_warmup > 0:
             self.scheduler = get_linear_scheduler(
@@ -264,7 +376,8 @@ class SingleStageTrainer(nn.Module):
                     target_sample_hz=target_sample_hz,
                     seq_len_multiple_of=seq_len_multiple_of,
                     ignore_files=default(ignore_files, []),
-                    ignore_load_errors=ignore_load_errors
+                    ignore_load_errors=ignore_load_errors,
+                    cache_folder=audio_cache_folder
                 )
 
         # split for validation
@@ -282,33 +395,60 @@ class SingleStageTrainer(nn.Module):
 
         # dataloader
 
+        # sqlite connections of the preprocessed dataset can't be shared with forked workers, so load in the main process by default
+
+        num_workers = default(num_workers, 0 if self.use_preprocessed_data else (os.cpu_count() or 0) // 2)
+        pin_memory = self.device.type == 'cuda'
+
+        dl_kwargs = dict(num_workers=num_workers, pin_memory=pin_memory)
+
+        if num_workers > 0:
+            # keep workers alive across epochs of the cycled dataloader
+            # cap the number of prefetched batches when pinning, since every in flight batch holds on to pinned host memory
+            dl_kwargs.update(
+                persistent_workers=persistent_workers,
+                prefetch_factor=min(prefetch_factor, 4) if pin_memory else prefetch_factor
+            )
+
+        # validation only runs every save_results_every steps, so load it in the main process
+        # rather than holding idle workers and their pinned buffers for the whole run
+
+        valid_dl_kwargs = dict(num_workers=0, pin_memory=pin_memory)
+
         if self.use_preprocessed_data:
-            self.dl = get_preprocessed_dataloader(self.ds, batch_size=batch_size, shuffle=True)
-            self.valid_dl = get_preprocessed_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True)
+            self.dl = get_preprocessed_dataloader(self.ds, batch_size=batch_size, shuffle=True, **dl_kwargs)
+            self.valid_dl = get_preprocessed_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True, **valid_dl_kwargs)
         else:
-            self.dl = get_dataloader(self.ds, batch_size=batch_size, shuffle=True)
-            self.valid_dl = get_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True)
+            self.dl = get_dataloader(self.ds, batch_size=batch_size, shuffle=True, **dl_kwargs)
+            self.valid_dl = get_dataloader(self.valid_ds, batch_size=batch_size, shuffle=True, **valid_dl_kwargs)
 
         # prepare with accelerator
+        # the training dataloader is left on the host, batches are moved to device by the prefetcher below
 
         (
             self.train_wrapper,
             self.optim,
-            self.dl,
             self.valid_dl
         ) = self.accelerator.prepare(
             self.train_wrapper,
             self.optim,
-            self.dl,
             self.valid_dl
         )
 
+        self.dl = self.accelerator.prepare_data_loader(self.dl, device_placement=False)
+
+        # fuse the stage forward with torch.compile. shapes may vary between batches (e.g. after removing unique consecutive semantic tokens),
+        # so dynamic shapes are left to the compiler rather than capturing static cuda graphs
+
+        if use_torch_compile and self.device.type == 'cuda' and hasattr(torch, 'compile'):
+            self.train_wrapper = torch.compile(self.train_wrapper)
+
         if exists(self.scheduler):
             self.scheduler = self.accelerator.prepare(self.scheduler)
 
         # dataloader iterators
 
-        self.dl_iter = cycle(self.dl)
+        self.dl_iter = prefetch_to_device(cycle(self.dl), self.device)
         self.valid_dl_iter = cycle(self.valid_dl)
 
         self.save_model_every = save_model_every
@@ -356,24 +496,39 @@ class SingleStageTrainer(nn.Module):
             for config_path in config_paths:
                 copy_file_to_folder(config_path, configs_folder)
 
+    def save_async(self, state_dict, path, save_fn=torch.save):
+        """snapshot the state dict to cpu now and write it to disk in the background"""
+        state_dict = copy_to_cpu(state_dict)
+        self.pending_saves.append(self.save_pool.submit(save_fn, state_dict, path))
+
+    def wait_for_saves(self):
+        """block until all background saves are written, raising any error that occurred while saving"""
+        pending_saves, self.pending_saves = self.pending_saves, []
+        for future in pending_saves:
+            future.result()
+
     def save(self, model_path, optim_path, scheduler_path=None):
+        # surface errors from the previous checkpoint before queueing the next one
+        self.wait_for_saves()
+
+        # model weights are saved with safetensors when model_path ends in .safetensors
         model_state_dict = self.accelerator.get_state_dict(self.transformer)
-        torch.save(model_state_dict, model_path)
+        self.save_async(model_state_dict, model_path, save_fn=save_state_dict)
 
         optim_state_dict = self.optim.state_dict()
-        torch.save(optim_state_dict, optim_path)
+        self.save_async(optim_state_dict, optim_path)
 
         if exists(self.scheduler):
             assert exists(scheduler_path)
             scheduler_state_dict = self.scheduler.state_dict()
-            torch.save(scheduler_state_dict, scheduler_path)
+            self.save_async(scheduler_state_dict, scheduler_path)
 
     def load(self, model_path, optim_path, scheduler_path=None, steps=0):
         model_path = Path(model_path)
         optim_path = Path(optim_path)
         assert model_path.exists() and optim_path.exists()
 
-        model_state_dict = torch.load(model_path, map_location=self.device)
+        model_state_dict = load_state_dict(model_path, device=self.device)
         optim_state_dict = torch.load(optim_path, map_location=self.device)
         transformer = self.accelerator.unwrap_model(self.transformer)
         transformer.load_state_dict(model_state_dict)
@@ -387,46 +542,52 @@ class SingleStageTrainer(nn.Module):
             self.scheduler.load_state_dict(scheduler_state_dict)
 
         if steps > 0:
-            assert int(self.steps.item()) == 0, 'steps should be 0 when loading a checkpoint for the first time'
-            self.steps += steps
+            assert self._py_steps == 0, 'steps should be 0 when loading a checkpoint for the first time'
+            self._py_steps += steps
+            self.steps.fill_(self._py_steps)
 
     def print(self, msg):
         self.accelerator.print(msg)
 
+    def data_tuple_to_kwargs(self, data):
+        # ds_fields is fixed per stage, so route the batch positionally without any per batch type checks
+        return dict(zip(self.ds_fields, data))
+
     def generate(self, *args, **kwargs):
         return self.train_wrapper.generate(*args, **kwargs)
 
-    @property
+    @cached_property
     def device(self):
         return self.accelerator.device
 
-    @property
+    @cached_property
     def is_distributed(self):
         return not (self.accelerator.distributed_type == DistributedType.NO and self.accelerator.num_processes == 1)
 
-    @property
+    @cached_property
     def is_main(self):
         return self.accelerator.is_main_process
 
-    @property
+    @cached_property
     def is_local_main(self):
         return self.accelerator.is_local_main_process
 
     def train_step(self):
         device = self.device
 
-        steps = int(self.steps.item())
-
-        self.transformer.train()
+        steps = self._py_steps
 
         # logs
 
         logs = {}
 
         # update vae (generator)
+        # accumulate the loss on device, so there is only one host sync per optimizer step
+
+        loss_accum = torch.zeros((), device=device)
 
-        for _ in range(self.grad_accum_every):
-            data_kwargs = dict(zip(self.ds_fields, next(self.dl_iter)))
+        for i in range(self.grad_accum_every):
+            data_kwargs = self.data_tuple_to_kwargs(next(self.dl_iter))
             non_empty_batch = False
             while non_empty_batch is False:
                 if len(data_kwargs) == 0:
@@ -434,20 +595,29 @@ class SingleStageTrainer(nn.Module):
 
                 non_empty_batch = True
 
-                loss, _, _ = self.train_wrapper(**data_kwargs, return_loss=True)
+                # only all-reduce gradients across processes on the last micro-batch
+
+                is_last = i == self.grad_accum_every - 1
+                sync_context = contextlib.nullcontext() if is_last else self.accelerator.no_sync(self.train_wrapper)
 
-                self.accelerator.backward(loss / self.grad_accum_every)
+                with sync_context:
+                    with self.accelerator.autocast():
+                        loss, _, _ = self.train_wrapper(**data_kwargs, return_loss=True)
 
-                accum_log(logs, {'loss': loss.item() / self.grad_accum_every})
+                    self.accelerator.backward(loss / self.grad_accum_every)
+
+                loss_accum += loss.detach() / self.grad_accum_every
 
         if exists(self.max_grad_norm):
             self.accelerator.clip_grad_norm_(self.transformer.parameters(), self.max_grad_norm)
 
         self.optim.step()
-        self.optim.zero_grad()
+        self.optim.zero_grad(set_to_none=True)
         if exists(self.scheduler):
             self.scheduler.step()
 
+        logs['loss'] = loss_accum.item()
+
         self.print(f"{steps}: loss: {logs['loss']}")
 
         # sample results every so often
@@ -457,15 +627,18 @@ class SingleStageTrainer(nn.Module):
         if not (steps % self.save_results_every):
             non_empty_batch = False
             while non_empty_batch is False:
-                data_kwargs = dict(zip(self.ds_fields, next(self.valid_dl_iter)))
+                data_kwargs = self.data_tuple_to_kwargs(next(self.valid_dl_iter))
                 if len(data_kwargs) == 0:
                     continue
 
                 non_empty_batch = True
 
-                with torch.no_grad():
-                    self.train_wrapper.eval()
-                    valid_loss, all_logits, all_labels = self.accelerator.unwrap_model(self.train_wrapper)(**data_kwargs, return_loss=True)
+                self.transformer_wrapper.eval()
+                try:
+                    with torch.inference_mode(), self.accelerator.autocast():
+                        valid_loss, all_logits, all_labels = self.accelerator.unwrap_model(self.train_wrapper)(**data_kwargs, return_loss=True)
+                finally:
+                    self.transformer_wrapper.train()
 
                 valid_loss = self.accelerator.reduce(valid_loss, 'mean').item()
 
@@ -537,26 +710,31 @@ class SingleStageTrainer(nn.Module):
 
             self.print(f'{steps}: saving model to {str(self.results_folder)}')
 
-            model_path = str(self.results_folder / f'{self.stage}.transformer.{steps}.pt')
+            model_path = str(self.results_folder / f'{self.stage}.transformer.{steps}.safetensors')
             optim_path = str(self.results_folder / f'{self.stage}.optimizer.{steps}.pt')
             scheduler_path = str(self.results_folder / f'{self.stage}.scheduler.{steps}.pt')
 
+            self.steps.fill_(self._py_steps)
             self.save(model_path, optim_path, scheduler_path)
 
             # save audio conditioner (clap) rvq checkpoint
             if exists(self.audio_conditioner) and self.audio_conditioner.learn_rvq:
                 rvq_state_dict = self.audio_conditioner.rq.state_dict()
-                torch.save(rvq_state_dict, str(self.results_folder / f'{self.stage}.conditioner_rvq.{steps}.pt'))
+                self.save_async(rvq_state_dict, str(self.results_folder / f'{self.stage}.conditioner_rvq.{steps}.pt'))
 
-        self.steps += 1
+        self._py_steps += 1
         return logs
 
     def train(self, log_fn=noop):
 
-        while self.steps < self.num_train_steps:
+        while self._py_steps < self.num_train_steps:
             logs = self.train_step()
             log_fn(logs)
 
+        self.steps.fill_(self._py_steps)
+
+        self.wait_for_saves()
+
         self.print('training complete')
 
 
@@ -670,19 +848,19 @@ class ClapRVQTrainer(nn.Module):
     def print(self, msg):
         self.accelerator.print(msg)
 
-    @property
+    @cached_property
     def device(self):
         return self.accelerator.device
 
-    @property
+    @cached_property
     def is_distributed(self):
         return not (self.accelerator.distributed_type == DistributedType.NO and self.accelerator.num_processes == 1)
 
-    @property
+    @cached_property
     def is_main(self):
         return self.accelerator.is_main_process
 
-    @property
+    @cached_property
     def is_local_main(self):
         return self.accelerator.is_local_main_process
 
@@ -822,19 +1000,19 @@ class HfHubertKmeansTrainer(nn.Module):
     def print(self, msg):
         self.accelerator.print(msg)
 
-    @property
+    @cached_property
     def device(self):
         return self.accelerator.device
 
-    @property
+    @cached_property
     def is_distributed(self):
         return not (self.accelerator.distributed_type == DistributedType.NO and self.accelerator.num_processes == 1)
 
-    @property
+    @cached_property
     def is_main(self):
         return self.accelerator.is_main_process
 
-    @property
+    @cached_property
     def is_local_main(self):
         return self.accelerator.is_local_main_process
 
@@ -9,6 +9,8 @@ import os
 from torchaudio.functional import resample
 
 from einops import rearrange, repeat, reduce
+from safetensors import safe_open
+from safetensors.torch import save_file
 
 def beartype_jit(func):
     """decorator to enable beartype only if USE_BEARTYPE is set to 1"""
@@ -171,4 +173,21 @@ def copy_file_to_folder(file_path: str, folder_path: str):
     config_file = Path(file_path)
     folder = Path(folder_path)
 
-    shutil.copy(str(config_file), str(folder / config_file.name))
\ No newline at end of file
+    shutil.copy(str(config_file), str(folder / config_file.name))
+
+# helpers for saving and loading flat state dicts, using safetensors for .safetensors paths and torch.save otherwise
+
+def save_state_dict(state_dict, path):
+    path = Path(path)
+    if path.suffix == '.safetensors':
+        save_file({key: value.contiguous() for key, value in state_dict.items()}, str(path))
+    else:
+        torch.save(state_dict, str(path))
+
+def load_state_dict(path, device = 'cpu'):
+    """safetensors checkpoints are memory mapped and loaded directly onto the target device"""
+    path = Path(path)
+    if path.suffix == '.safetensors':
+        with safe_open(str(path), framework = 'pt', device = str(device)) as f:
+            return {key: f.get_tensor(key) for key in f.keys()}
+    return torch.load(str(path), map_location = device)
@@ -2,9 +2,9 @@
 example usage:
 
 python3 scripts/infer.py \
-  --semantic_path ./results/semantic/semantic.transformer.10000.pt \
-  --coarse_path ./results/coarse/coarse.transformer.10000.pt \
-  --fine_path ./results/fine/fine.transformer.10000.pt \
+  --semantic_path ./results/semantic/semantic.transformer.10000.safetensors \
+  --coarse_path ./results/coarse/coarse.transformer.10000.safetensors \
+  --fine_path ./results/fine/fine.transformer.10000.safetensors \
   --model_config ./configs/model/musiclm_small.json \
   --return_coarse_wave
 '''
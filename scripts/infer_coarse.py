@@ -11,7 +11,7 @@ python scripts/infer_coarse.py \
     ./data/fma_large/000/000005.mp3 \
     ./data/fma_large/000/000010.mp3 \
     --model_config ./configs/model/musiclm_small.json \
-    --coarse_path ./results/coarse_continue_1/coarse.transformer.10000.pt
+    --coarse_path ./results/coarse_continue_1/coarse.transformer.10000.safetensors
 
 '''
 
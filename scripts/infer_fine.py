@@ -11,7 +11,7 @@ python scripts/infer_fine.py \
     ./data/fma_large/000/000005.mp3 \
     ./data/fma_large/000/000010.mp3 \
     --model_config ./configs/model/musiclm_small.json \
-    --fine_path ./results/coarse_continue_1/coarse.transformer.10000.pt
+    --fine_path ./results/coarse_continue_1/coarse.transformer.10000.safetensors
 '''
 
 import argparse
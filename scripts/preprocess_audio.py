@@ -0,0 +1,25 @@
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from open_musiclm.data import SoundDataset, cache_resampled_audio
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='resample audio once and cache it to disk for training')
+    parser.add_argument('--folder', default='./data/fma_large')
+    parser.add_argument('--cache_folder', default='./data/fma_large_resampled')
+    # clap, hubert and encodec sample rates
+    parser.add_argument('--target_sample_hz', default=[48000, 16000, 24000], type=int, nargs='+')
+
+    args = parser.parse_args()
+
+    print(f'caching audio from {args.folder} resampled to {args.target_sample_hz} hz in {args.cache_folder}')
+
+    # only used to find the sound files
+    dataset = SoundDataset(args.folder, max_length_seconds=None)
+
+    num_cached = cache_resampled_audio(dataset.files, args.cache_folder, tuple(args.target_sample_hz))
+
+    print(f'cached {num_cached} out of {len(dataset.files)} files')
@@ -25,7 +25,7 @@ def get_latest_checkpoints(results_folder, max_step=None):
     scheduler_path = None
     max_step = float('inf') if max_step is None else max_step
     for file in os.listdir(results_folder):
-        if file.endswith('.pt'):
+        if file.endswith('.pt') or file.endswith('.safetensors'):
             if 'transformer' in file:
                 step = int(file.split('.')[2])
                 if step > highest_transformer_step and step <= max_step:
@@ -40,6 +40,7 @@ setup(
     'beartype',
     'joblib',
     'h5py',
+    'safetensors',
     'scikit-learn',
     'wget',
   ],